@@ -2,14 +2,22 @@
 A Spawner for JupyterHub that runs each user's server in a separate Docker Service
 """
 
+import logging
 import math
+import socket
 import string
-from asyncio import sleep
+from copy import deepcopy
+from functools import lru_cache
+from operator import attrgetter
+from asyncio import get_event_loop, sleep, wrap_future, Semaphore
 from textwrap import dedent
 from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
-from docker import DockerClient
-from docker.errors import APIError, NotFound
+from weakref import WeakKeyDictionary
+from docker import APIClient, DockerClient
+from docker.errors import APIError, DockerException, NotFound
+# Private docker-py helper, relies on the docker==4.3.1 pin in requirements.txt
+from docker.models.services import _get_create_service_kwargs
 from docker.tls import TLSConfig
 from docker.types import (
     EndpointSpec,
@@ -27,12 +35,19 @@ from docker.types import (
     ConfigReference,
     DriverConfig
 )
+from docker.transport.unixconn import UnixHTTPAdapter, UnixHTTPConnectionPool
 from docker.utils import kwargs_from_env
-from tornado import gen
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from tornado.web import HTTPError
 from jupyterhub.spawner import Spawner
-from traitlets import default, Dict, List, Unicode
-from flatten_dict import flatten, unflatten
+from traitlets import default, observe, validate, Dict, Int, List, TraitError, Unicode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class SwarmSpawner(Spawner):
     """
@@ -95,6 +110,33 @@ class SwarmSpawner(Spawner):
         ),
     )
 
+    docker_client_pool_size = Int(
+        64,
+        config=True,
+        help=dedent(
+            """
+            Maximum number of connections to the Docker daemon kept open
+            by the shared client.
+
+            Should be at least the number of expected concurrent spawns,
+            otherwise the requests are waiting for a free connection.
+            """
+        ),
+    )
+
+    docker_executor_workers = Int(
+        32,
+        config=True,
+        help=dedent(
+            """
+            Number of threads used to call the Docker API.
+
+            The threads are shared by all spawners, so this limits
+            the number of concurrent Docker requests.
+            """
+        ),
+    )
+
     form_template = Unicode(
         """
         <label for="profile">Select configuration:</label>
@@ -112,6 +154,18 @@ class SwarmSpawner(Spawner):
         help="Template for html form options.",
     )
 
+    # Profiles are validated merged with the default configuration, when both
+    # are loaded from the config file the validation runs after both are set
+    @validate("default_config")
+    def _validate_default_config(self, proposal):
+        _validate_configs(proposal["value"], self.profiles)
+        return proposal["value"]
+
+    @validate("profiles")
+    def _validate_profiles(self, proposal):
+        _validate_configs(self.default_config, proposal["value"])
+        return proposal["value"]
+
     @default("port")
     def _port_default(self):
         return 8888
@@ -121,21 +175,35 @@ class SwarmSpawner(Spawner):
     def _env_keep(self):
         return []
 
+    _cached_form = None
+
     @default("options_form")
     def _options_form(self):
+        if self._cached_form is None:
+            self._cached_form = self._render_options_form()
+        return self._cached_form
+
+    @observe("profiles", "form_template", "option_template")
+    def _update_options_form(self, change):
+        # Re-render the form only if it was rendered from the profiles,
+        # not when the options_form was configured explicitly
+        if self._cached_form is not None and self.options_form is self._cached_form:
+            self._cached_form = self._render_options_form()
+            self.options_form = self._cached_form
+
+    def _render_options_form(self):
         if not self.profiles:
             return ""
 
-        options = [
+        options = "".join(
             self.option_template.format(
                 name=prof["name"],
                 title=prof.get("title", prof["name"]),
                 selected=("selected" if i == 0 else ""))
             for i, prof in enumerate(self.profiles)
-        ]
+        )
 
-        form = self.form_template.format(option_template="".join(options))
-        return form
+        return self.form_template.format(option_template=options)
 
     def options_from_form(self, form_data):
         if "profile" in form_data:
@@ -156,20 +224,43 @@ class SwarmSpawner(Spawner):
 
     @default("service_name")
     def _service_name(self):
-        return (self.format_string("{prefix}-{_username}-{_servername}")
-                if self.name else
-                self.format_string("{prefix}-{_username}"))
+        # Same as formatting "{prefix}-{_username}[-{_servername}]",
+        # without building the whole template namespace
+        name = "{}-{}".format(self.name_prefix, _escape(self.user.name))
+        if self.name:
+            name = "{}-{}".format(name, _escape(self.name))
+        return name
 
     _executor = None
 
     @property
-    def executor(self, max_workers=1):
+    def executor(self):
         """Single global executor"""
         cls = self.__class__
         if cls._executor is None:
-            cls._executor = ThreadPoolExecutor(max_workers)
+            cls._executor = ThreadPoolExecutor(
+                max_workers=self.docker_executor_workers,
+                thread_name_prefix="swarmspawner"
+            )
         return cls._executor
 
+    _semaphores = None
+
+    @property
+    def semaphore(self):
+        """Global semaphore limiting concurrent Docker requests, one per event loop"""
+        cls = self.__class__
+        if cls._semaphores is None:
+            cls._semaphores = WeakKeyDictionary()
+        # The semaphore binds the loop it is created in on Python < 3.10
+        loop = get_event_loop()
+        if loop not in cls._semaphores:
+            # Requests over the limit wait here, not in the executor queue
+            cls._semaphores[loop] = Semaphore(
+                min(self.docker_client_pool_size, self.docker_executor_workers)
+            )
+        return cls._semaphores[loop]
+
     _client = None
 
     @property
@@ -182,7 +273,8 @@ class SwarmSpawner(Spawner):
             if self.docker_client_tls_config:
                 kwargs["tls"] = TLSConfig(**self.docker_client_tls_config)
             kwargs.update(kwargs_from_env())
-            cls._client = DockerClient(version="auto", **kwargs)
+            cls._client = _DockerClient(version="auto", **kwargs)
+            _configure_adapters(cls._client.api, self.docker_client_pool_size)
 
         return cls._client
 
@@ -199,29 +291,30 @@ class SwarmSpawner(Spawner):
     def clear_state(self):
         super().clear_state()
         self.service_id = ""
+        self._format_cache = None
 
     def _docker(self, method, *args, **kwargs):
         """
         Wrapper for calling docker methods to be passed to ThreadPoolExecutor
         """
-        m = self.client
-        for attr in method.split("."):
-            m = getattr(m, attr)
-        return m(*args, **kwargs)
+        return _resolver(method)(self.client)(*args, **kwargs)
 
-    def docker(self, method, *args, **kwargs):
+    async def docker(self, method, *args, **kwargs):
         """
-        Call a docker method in a background thread returns a Future
+        Call a docker method in a background thread, the number of requests
+        in flight is limited by the executor threads and the connection pool
         """
-        return self.executor.submit(self._docker, method, *args, **kwargs)
+        async with self.semaphore:
+            return await wrap_future(
+                self.executor.submit(self._docker, method, *args, **kwargs)
+            )
 
-    @gen.coroutine
-    def get_service(self):
+    async def get_service(self):
         self.log.debug(
             "Getting Docker service {}".format(self.service_name)
         )
         try:
-            service = yield self.docker("services.get", self.service_name)
+            service = await self.docker("services.get", self.service_name)
             self.service_id = service.id
         except NotFound:
                 self.log.info("Docker service {} not found".format(self.service_name))
@@ -238,20 +331,35 @@ class SwarmSpawner(Spawner):
                 raise err
         return service
 
+    _format_cache = None
+
+    def _format_cached(self, s):
+        """
+        Format string with the result cached until the state is cleared
+        """
+        if self._format_cache is None:
+            self._format_cache = {}
+        val = self._format_cache.get(s)
+        if val is None:
+            val = self._format_cache[s] = self.format_string(s)
+        return val
+
     def _format_param(self, config, param):
         val = config.get(param)
         if val:
             if isinstance(val, str):
-                config[param] = self.format_string(param)
+                config[param] = self.format_string(val)
             elif isinstance(val, list):
                 config[param] = [self.format_string(elm) for elm in val]
 
     def _format_mount(self, mount):
         if isinstance(mount, str):
-            return self.format_string(mount)
+            return self._format_cached(mount)
         elif isinstance(mount, dict):
-            mount["target"] = self.format_string(mount["target"])
-            mount["source"] = self.format_string(mount["source"])
+            # Parsed docker.types.Mount
+            mount["Target"] = self._format_cached(mount["Target"])
+            if mount.get("Source"):
+                mount["Source"] = self._format_cached(mount["Source"])
             return mount
 
     def _format_config(self, config):
@@ -268,12 +376,12 @@ class SwarmSpawner(Spawner):
         configs = config.get("configs")
         if configs:
             for conf in configs:
-                self._format_param(conf, "filename")
+                self._format_param(conf["File"], "Name")
 
         secrets = config.get("secrets")
         if secrets:
             for secr in secrets:
-                self._format_param(secr, "filename")
+                self._format_param(secr["File"], "Name")
 
         labels = config.get("labels")
         if labels:
@@ -287,13 +395,43 @@ class SwarmSpawner(Spawner):
 
         return config
 
+    _service_templates = None
+
+    def _service_template(self, user_profile):
+        """
+        Default service configuration merged with the user profile and
+        parsed to docker types, built once per profile and shared by all
+        spawners. Returns a copy which can be modified.
+        """
+        profile_configs = [
+            prof.get("config", {}) for prof in self.profiles
+            if user_profile and user_profile == prof.get("name")
+        ]
+
+        cls = self.__class__
+        if cls._service_templates is None:
+            cls._service_templates = {}
+        # Each spawner has its own copy of the configuration,
+        # the template is rebuilt only if the configuration differs
+        cached = cls._service_templates.get(user_profile)
+        if (cached is None or cached[0] != self.default_config or
+                cached[1] != profile_configs):
+            config = {}
+            if self.default_config:
+                config = _update_config(config, self.default_config)
+            for profile_config in profile_configs:
+                config = _update_config(config, profile_config)
+            cached = (self.default_config, profile_configs, _parse_config(config))
+            cls._service_templates[user_profile] = cached
+        return deepcopy(cached[2])
+
     def get_service_config(self):
         config = {}
 
         config["name"] = self.service_name
         config["command"] = self.cmd
         config["args"] = self.get_args()
-        config["env"] = ["{}={}".format(k, v) for k, v in self.get_env().items()]
+        config["env"] = [f"{k}={v}" for k, v in self.get_env().items()]
 
         resources = {}
         if self.cpu_limit:
@@ -307,20 +445,15 @@ class SwarmSpawner(Spawner):
             mem = self.mem_guarantee
             resources["mem_reservation"] = mem.lower() if isinstance(mem, str) else mem
         if resources:
-            config["resources"] = resources
-
-        if self.default_config:
-            config = _update_config(config, self.default_config)
+            config["resources"] = Resources(**resources)
 
+        # Only the options set by the spawner are merged into the template,
+        # the options from the template take precedence
         user_profile = self.user_options.get("user_profile", "")
-        if user_profile:
-            for prof in self.profiles:
-                if user_profile == prof.get("name"):
-                    profile_config = prof.get("config", {})
-                    config = _update_config(config, profile_config)
+        config = _merge_defaults(self._service_template(user_profile), config)
 
         image = config["image"]
-        config["env"].append("JUPYTER_IMAGE_SPEC={}".format(image))
+        config["env"].append(f"JUPYTER_IMAGE_SPEC={image}")
 
         labels = {
             "org.jupyterhub.user": self.user.name,
@@ -338,22 +471,22 @@ class SwarmSpawner(Spawner):
 
         config = self._format_config(config)
 
-        self.log.debug(
-            "Config for service {}: {}".format(
-                self.service_name, pformat(config)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(
+                "Config for service {}: {}".format(
+                    self.service_name, pformat(config)
+                )
             )
-        )
 
         return config
 
-    @gen.coroutine
-    def start(self):
+    async def start(self):
         """
         Start the single-user server in a docker service.
         You can specify the params for the service through
         jupyterhub_config.py or using the user_options.
         """
-        service = yield self.get_service()
+        service = await self.get_service()
 
         if service is None:
             self.log.info(
@@ -362,10 +495,14 @@ class SwarmSpawner(Spawner):
                 )
             )
             config = self.get_service_config()
-            config = _parse_config(config)
+            # Create the service through the low-level API, services.create
+            # would inspect the new service again just to return the model.
+            # _get_create_service_kwargs is private in docker-py, check it
+            # when upgrading from the pinned docker==4.3.1.
+            create_kwargs = _get_create_service_kwargs("create", dict(config))
             try:
-                service = yield self.docker("services.create", **config)
-                self.service_id = service.id
+                result = await self.docker("api.create_service", **create_kwargs)
+                self.service_id = result["ID"]
             except APIError as err:
                 self.log.error(
                     "Error creating Docker service {} with config: {}".format(
@@ -378,7 +515,7 @@ class SwarmSpawner(Spawner):
                     self.service_name, self.service_id[:7], config["image"], self.user.name
                 )
             )
-            yield self.wait_for_running_tasks()
+            await self.wait_for_running_tasks()
         else:
             self.log.info(
                 "Found existing Docker service {} with id {}".format(
@@ -389,10 +526,13 @@ class SwarmSpawner(Spawner):
             # Get the API token from the environment variables
             # of the running service:
             envs = service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Env"]
-            for line in envs:
-                if line.startswith("JPY_API_TOKEN="):
-                    self.api_token = line.split("=", 1)[1]
-                    break
+            api_token = next(
+                (line[len(_API_TOKEN_PREFIX):] for line in envs
+                 if line.startswith(_API_TOKEN_PREFIX)),
+                None
+            )
+            if api_token is not None:
+                self.api_token = api_token
 
         # We use service_name instead of ip
         # https://docs.docker.com/engine/swarm/networking/#use-swarm-mode-service-discovery
@@ -402,8 +542,7 @@ class SwarmSpawner(Spawner):
 
         return ip, port
 
-    @gen.coroutine
-    def stop(self, now=False):
+    async def stop(self, now=False):
         """
         Stop and remove the service
         Consider using stop/start when Docker adds support
@@ -415,7 +554,7 @@ class SwarmSpawner(Spawner):
         )
 
         try:
-            result = yield self.docker("api.remove_service", self.service_name)
+            result = await self.docker("api.remove_service", self.service_name)
             # Even though it returns the service is gone
             # the underlying containers are still being removed
             if result:
@@ -433,12 +572,18 @@ class SwarmSpawner(Spawner):
 
         self.clear_state()
 
-    @gen.coroutine
-    def poll(self):
+    async def poll(self):
         """Check for a task state like `docker service ps id`"""
 
+        # Only the current tasks are relevant, not the service history.
+        # When swarm restarts or reschedules a task (e.g. node drain), the old
+        # task is shut down and the new one waits with desired state ready.
+        filters = {
+            "service": self.service_name,
+            "desired-state": ["running", "ready"]
+        }
         try:
-            tasks = yield self.docker("api.tasks", {"service": self.service_name})
+            tasks = await self.docker("api.tasks", filters)
         except NotFound:
             self.log.warn(
                 "Docker service {} not found".format(self.service_name)
@@ -450,41 +595,51 @@ class SwarmSpawner(Spawner):
             )
             return 0
 
-        running_task = None
+        pending_task = None
         for task in tasks:
             task_state = task["Status"]["State"]
             if task_state == "running":
                 self.log.debug(
                     "Task {} of service with id {} status: {}".format(
-                        task["ID"][:7], self.service_id[:7], pformat(task_state)
+                        task["ID"][:7], self.service_id[:7], task_state
                     )
                 )
                 # There should be at most one running task
-                running_task = task
+                return None
             if task_state == "rejected":
                 task_err = task["Status"]["Err"]
                 self.log.error(
                     "Task {} of service with id {} status: {} message: {}".format(
                         task["ID"][:7],
                         self.service_id[:7],
-                        pformat(task_state),
-                        pformat(task_err),
+                        task_state,
+                        task_err,
                     )
                 )
                 # If the task is rejected -> remove service
-                yield self.stop()
-
-        if running_task is not None:
+                await self.stop()
+                return 0
+            if task["DesiredState"] == "ready":
+                pending_task = task
+
+        if pending_task is not None:
+            self.log.debug(
+                "Task {} of service with id {} is waiting to start".format(
+                    pending_task["ID"][:7], self.service_id[:7]
+                )
+            )
+            # The task is being replaced, the server is not gone
             return None
-        else:
-            return 0
-
-    @gen.coroutine
-    def wait_for_running_tasks(self, max_attempts=20):
-        preparing, running = False, False
-        attempt = 0
-        while not running:
-            tasks = yield self.docker("api.tasks", {"service": self.service_name})
+        return 0
+
+    async def wait_for_running_tasks(self, timeout=20.0, max_delay=5.0):
+        # The service was just created, so all of its tasks are listed
+        # to see a rejected task even after swarm has shut it down
+        filters = {"service": self.service_name}
+        waited = 0.0
+        delay = 0.25
+        while waited <= timeout:
+            tasks = await self.docker("api.tasks", filters)
             preparing = False
             for task in tasks:
                 task_state = task["Status"]["State"]
@@ -494,14 +649,18 @@ class SwarmSpawner(Spawner):
                     )
                 )
                 if task_state == "running":
-                    running = True
+                    return True
                 if task_state == "preparing":
                     preparing = True
-                if task_state == "rejected" or attempt > max_attempts:
+                if task_state == "rejected":
                     return False
+            # Time spent preparing, e.g. pulling the image, is not counted
             if not preparing:
-                attempt += 1
-            yield gen.sleep(1)
+                waited += delay
+            # Back off exponentially, the image pull can take a while
+            await sleep(delay)
+            delay = min(delay * 1.5, max_delay)
+        return False
 
     def template_namespace(self):
         ns = super().template_namespace()
@@ -515,6 +674,82 @@ class SwarmSpawner(Spawner):
             ns["profile"] = profile
         return ns
 
+class _APIClient(APIClient):
+    """
+    APIClient decoding JSON responses with orjson if it is installed
+    """
+
+    def _result(self, response, json=False, binary=False):
+        if json and orjson is not None:
+            self._raise_for_status(response)
+            return orjson.loads(response.content)
+        return super()._result(response, json, binary)
+
+class _DockerClient(DockerClient):
+    def __init__(self, *args, **kwargs):
+        self.api = _APIClient(*args, **kwargs)
+
+class _UnixHTTPAdapter(UnixHTTPAdapter):
+    """
+    UnixHTTPAdapter with configurable size of the connection pool
+    """
+
+    __attrs__ = UnixHTTPAdapter.__attrs__ + ["pool_maxsize"]
+
+    def __init__(self, socket_url, timeout=60, pool_connections=10, pool_maxsize=10):
+        self.pool_maxsize = pool_maxsize
+        super().__init__(socket_url, timeout, pool_connections)
+
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(url)
+            if pool:
+                return pool
+
+            pool = UnixHTTPConnectionPool(
+                url, self.socket_path, self.timeout, maxsize=self.pool_maxsize
+            )
+            self.pools[url] = pool
+
+        return pool
+
+# Retry failed connections, only idempotent requests are retried after being sent
+_RETRIES = Retry(total=3, backoff_factor=0.1)
+
+# Keep idle TCP connections to the daemon open, TCP_NODELAY is set by urllib3
+_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+]
+
+def _configure_adapters(api, size):
+    """
+    Resize connection pools of all HTTP adapters mounted on the API client
+    and configure them to reuse the connections
+    """
+    for prefix, adapter in list(api.adapters.items()):
+        if isinstance(adapter, UnixHTTPAdapter):
+            resized = _UnixHTTPAdapter(
+                adapter.socket_path, adapter.timeout, size, size
+            )
+            resized.max_retries = _RETRIES
+            if api._custom_adapter is adapter:
+                api._custom_adapter = resized
+            api.mount(prefix, resized)
+            adapter.close()
+        elif isinstance(adapter, HTTPAdapter):
+            adapter.init_poolmanager(size, size)
+            adapter.poolmanager.connection_pool_kw["socket_options"] = _SOCKET_OPTIONS
+            adapter.max_retries = _RETRIES
+
+@lru_cache(maxsize=None)
+def _resolver(method):
+    """
+    Getter for the docker method with the dotted name
+    """
+    return attrgetter(method)
+
+_API_TOKEN_PREFIX = "JPY_API_TOKEN="
+
 _DOCKER_NAME_CHARS = set(string.ascii_letters + string.digits + "-.")
 
 def _escape(s):
@@ -526,57 +761,118 @@ def _escape(s):
             chars.append("_0x{:x}".format(ord(c)))
     return "".join(chars)
 
+_MOUNT_TYPES = {
+    "driver_config": DriverConfig
+}
+
+# Option types, a tuple is the type with the types of its own options
 _SERVICE_TYPES = {
     "endpoints": EndpointSpec,
     "mode": ServiceMode,
-    "mounts": Mount,
+    "mounts": (Mount, _MOUNT_TYPES),
     "networks": NetworkAttachmentConfig,
     "resources": Resources,
     "restart_policy": RestartPolicy,
     "secrets": SecretReference,
     "update_config": UpdateConfig,
-    "roleback_config": RollbackConfig,
+    "rollback_config": RollbackConfig,
     "healthcheck": Healthcheck,
     "dns_config": DNSConfig,
     "configs": ConfigReference,
     "privileges": Privileges
 }
 
-_MOUNT_TYPES = {
-    "driver_config": DriverConfig
-}
+def _identity(val):
+    return val
+
+def _type_parser(opt_type, types=None):
+    dispatch = _dispatch_table(types) if types else None
+
+    def parse(val):
+        # Values which are already docker types are not parsed again
+        if isinstance(val, opt_type) or not isinstance(val, dict):
+            return val
+        if dispatch:
+            val = _parse_obj(val, dispatch)
+        return opt_type(**val)
+
+    def parse_option(val):
+        if isinstance(val, (list, tuple)):
+            return [parse(elm) for elm in val]
+        return parse(val)
 
-def _parse_obj(obj, types):
+    return parse_option
+
+def _dispatch_table(types):
+    """
+    Parsers for the option values keyed by the option name
+    """
+    return {
+        opt: (_type_parser(*opt_type) if isinstance(opt_type, tuple) else
+              _type_parser(opt_type))
+        for opt, opt_type in types.items()
+    }
+
+_SERVICE_DISPATCH = _dispatch_table(_SERVICE_TYPES)
+
+def _parse_obj(obj, dispatch):
     if not isinstance(obj, dict):
         return obj
 
-    for opt, val in obj.items():
-        opt_type = types.get(opt)
-        if opt_type:
-            if isinstance(val, dict):
-                obj[opt] = opt_type(**val)
-            elif isinstance(val, list):
-                obj[opt] = [opt_type(**elm) if isinstance(elm, dict) else elm
-                           for elm in val]
-    return obj
+    get = dispatch.get
+    return {opt: get(opt, _identity)(val) for opt, val in obj.items()}
 
 def _parse_config(config):
-    mounts = config.get("mounts")
-    if mounts:
-        config["mounts"] = [_parse_obj(mount, _MOUNT_TYPES) for mount in mounts]
-    config = _parse_obj(config, _SERVICE_TYPES)
+    return _parse_obj(config, _SERVICE_DISPATCH)
+
+def _validate_config(config):
+    """
+    Check that the service configuration can be parsed to docker types.
+    The configuration is kept as it is, so partial options from profiles
+    are merged before they are filled with the defaults of docker types.
+    """
+    try:
+        _parse_config(config)
+    except (TypeError, DockerException) as err:
+        raise TraitError("Invalid Docker service configuration: {}".format(err))
+
+def _validate_configs(default_config, profiles):
+    """
+    Check the default configuration and the configuration of each profile
+    merged with it, profiles can override only some of the default options
+    """
+    _validate_config(default_config)
+    for prof in profiles:
+        config = _update_config({}, default_config)
+        _validate_config(_update_config(config, prof.get("config", {})))
+
+def _merge_defaults(config, defaults):
+    """
+    Merge defaults into config, options already set in config are kept
+    """
+    for opt, val1 in defaults.items():
+        val2 = config.get(opt)
+        if opt not in config:
+            config[opt] = val1
+        elif isinstance(val1, dict) and isinstance(val2, dict):
+            _merge_defaults(val2, val1)
+        elif isinstance(val1, list) and isinstance(val2, list):
+            config[opt] = val1 + val2 # Prepend defaults for lists
+
     return config
 
 def _update_config(config, update):
-    config = flatten(config)
-    update = flatten(update)
-
     for opt, val2 in update.items():
-        if isinstance(val2, list) and opt in config:
-            val1 = config[opt]
-            assert isinstance(val1, list)
+        val1 = config.get(opt)
+        if isinstance(val2, dict):
+            if isinstance(val1, dict):
+                _update_config(val1, val2)
+            else:
+                # Copy nested dicts, the update is not modified
+                config[opt] = deepcopy(val2)
+        elif isinstance(val2, list) and isinstance(val1, list):
             config[opt] = val1 + val2 # Append update for lists
         else:
             config[opt] = val2
 
-    return unflatten(config)
+    return config
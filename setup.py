@@ -36,7 +36,11 @@ setup(
     license = "BSD",
     platforms = "Linux, Mac OS X",
     keywords = ["Interactive", "Interpreter", "Shell", "Web"],
+    python_requires = ">=3.6",
     install_requires = read_req("requirements.txt"),
+    extras_require = {
+        "orjson": ["orjson"],
+    },
     entry_points = {
         'jupyterhub.spawners': ['docker-swarm = dockerspawner:SwarmSpawner']
     },
@@ -47,7 +51,6 @@ setup(
         "Intended Audience :: Science/Research",
         "Topic :: Software Development :: Libraries :: Python Modules",
         "License :: OSI Approved :: BSD License",
-        "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
@@ -0,0 +1,73 @@
+"Tests for SwarmSpawner service configuration"
+
+from collections import OrderedDict
+
+import pytest
+from docker.types import Mount, Resources
+from traitlets import TraitError
+from dockerspawner import SwarmSpawner
+from dockerspawner.spawners import _parse_config
+
+def test_profile_overrides_default_config():
+    spawner = SwarmSpawner(
+        default_config={
+            "image": "jupyterhub/singleuser:latest",
+            "restart_policy": {"condition": "on-failure", "max_attempts": 3},
+            "update_config": {"parallelism": 2, "failure_action": "rollback"}
+        },
+        profiles=[{
+            "name": "profile",
+            "config": {
+                "restart_policy": {"delay": 5000000000},
+                "update_config": {"delay": 10}
+            }
+        }]
+    )
+
+    config = spawner._service_template("profile")
+
+    restart_policy = config["restart_policy"]
+    assert restart_policy["Condition"] == "on-failure"
+    assert restart_policy["MaxAttempts"] == 3
+    assert restart_policy["Delay"] == 5000000000
+
+    update_config = config["update_config"]
+    assert update_config["Parallelism"] == 2
+    assert update_config["FailureAction"] == "rollback"
+    assert update_config["Delay"] == 10
+
+    # The configured options are not modified
+    assert spawner.default_config["restart_policy"] == {
+        "condition": "on-failure", "max_attempts": 3
+    }
+
+def test_parse_config():
+    resources = Resources(cpu_limit=1000000000)
+    config = _parse_config({
+        "image": "jupyterhub/singleuser:latest",
+        "mounts": (OrderedDict(source="data", target="/data"), "/home:/home:ro"),
+        "resources": resources
+    })
+
+    mount = config["mounts"][0]
+    assert isinstance(mount, Mount)
+    assert mount["Source"] == "data"
+    assert mount["Target"] == "/data"
+    assert config["mounts"][1] == "/home:/home:ro"
+    # Docker types are not parsed again
+    assert config["resources"] is resources
+
+def test_profile_validated_with_default_config():
+    default_config = {
+        "image": "jupyterhub/singleuser:latest",
+        "mode": {"mode": "replicated"}
+    }
+    profiles = [{"name": "profile", "config": {"mode": {"replicas": 2}}}]
+
+    spawner = SwarmSpawner(default_config=default_config, profiles=profiles)
+    assert spawner._service_template("profile")["mode"] == {
+        "replicated": {"Replicas": 2}
+    }
+
+    with pytest.raises(TraitError):
+        SwarmSpawner(profiles=[{"name": "profile", "config": {"mode": {"bogus": 1}}}])
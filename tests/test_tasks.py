@@ -0,0 +1,162 @@
+"Tests for SwarmSpawner Docker requests, task polling and waiting"
+
+import asyncio
+import threading
+import time
+
+import pytest
+from unittest.mock import Mock, patch
+from dockerspawner import SwarmSpawner
+
+class _AsyncCalls:
+    """Coroutine function recording its calls"""
+
+    def __init__(self, result=None):
+        self.result = result
+        self.calls = []
+
+    async def __call__(self, *args, **kwargs):
+        self.calls.append(args)
+        return self.result
+
+def _spawner(cls=SwarmSpawner, **kwargs):
+    user = Mock()
+    user.name = "user"
+    orm_spawner = Mock()
+    orm_spawner.name = ""
+    orm_spawner.server = None
+    return cls(user=user, orm_spawner=orm_spawner, **kwargs)
+
+class _LimitedSpawner(SwarmSpawner):
+    """Spawner with its own executor and semaphores"""
+
+    _executor = None
+    _semaphores = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _docker(self, method, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return method
+
+@pytest.mark.asyncio
+async def test_docker_limit():
+    spawner = _spawner(_LimitedSpawner, docker_client_pool_size=2)
+    results = await asyncio.gather(
+        *(spawner.docker("api.info") for _ in range(10))
+    )
+    assert results == ["api.info"] * 10
+    assert spawner.max_in_flight == 2
+
+def test_semaphore_per_loop():
+    spawner = _spawner(_LimitedSpawner)
+
+    async def semaphore():
+        return spawner.semaphore
+
+    semaphores = []
+    for _ in range(2):
+        loop = asyncio.new_event_loop()
+        try:
+            semaphores.append(loop.run_until_complete(semaphore()))
+            assert loop.run_until_complete(semaphore()) is semaphores[-1]
+        finally:
+            loop.close()
+    assert semaphores[0] is not semaphores[1]
+
+def _task(task_id, desired_state, state, err=None):
+    status = {"State": state}
+    if err:
+        status["Err"] = err
+    return {"ID": task_id, "DesiredState": desired_state, "Status": status}
+
+async def _poll(tasks):
+    spawner = _spawner()
+    docker = _AsyncCalls(tasks)
+    stop = _AsyncCalls()
+    with patch.object(SwarmSpawner, "docker", docker), \
+            patch.object(SwarmSpawner, "stop", stop):
+        status = await spawner.poll()
+
+    [(method, filters)] = docker.calls
+    assert method == "api.tasks"
+    assert filters == {
+        "service": "jupyter-user",
+        "desired-state": ["running", "ready"]
+    }
+    return status, stop
+
+@pytest.mark.asyncio
+async def test_poll_running():
+    status, stop = await _poll([_task("running-task", "running", "running")])
+    assert status is None
+    assert not stop.calls
+
+@pytest.mark.asyncio
+async def test_poll_rejected():
+    status, stop = await _poll([
+        _task("rejected-task", "running", "rejected", "no suitable node")
+    ])
+    assert status == 0
+    assert len(stop.calls) == 1
+
+@pytest.mark.asyncio
+async def test_poll_pending_replacement():
+    # The replaced task is still running with desired state shutdown,
+    # e.g. when the node is drained, so it is filtered out by the daemon
+    status, stop = await _poll([_task("new-task", "ready", "pending")])
+    assert status is None
+    assert not stop.calls
+
+@pytest.mark.asyncio
+async def test_poll_no_tasks():
+    status, stop = await _poll([])
+    assert status == 0
+    assert not stop.calls
+
+async def _wait(tasks, timeout=20.0):
+    spawner = _spawner()
+    docker = _AsyncCalls(tasks)
+    sleep = _AsyncCalls()
+    with patch.object(SwarmSpawner, "docker", docker), \
+            patch("dockerspawner.spawners.sleep", sleep):
+        running = await spawner.wait_for_running_tasks(timeout=timeout)
+    return running, docker, sleep
+
+@pytest.mark.asyncio
+async def test_wait_running():
+    running, docker, sleep = await _wait([
+        _task("new-task", "running", "running")
+    ])
+    assert running is True
+    assert docker.calls == [("api.tasks", {"service": "jupyter-user"})]
+    assert not sleep.calls
+
+@pytest.mark.asyncio
+async def test_wait_rejected():
+    running, docker, sleep = await _wait([
+        _task("rejected-task", "shutdown", "rejected", "no suitable node")
+    ])
+    assert running is False
+    assert len(docker.calls) == 1
+
+@pytest.mark.asyncio
+async def test_wait_timeout():
+    running, docker, sleep = await _wait([
+        _task("new-task", "running", "pending")
+    ])
+    assert running is False
+    # The delays back off and the loop ends once they add up to the timeout
+    delays = [args[0] for args in sleep.calls]
+    assert sum(delays[:-1]) <= 20.0 < sum(delays)
+    assert max(delays) == 5.0
+    assert len(docker.calls) == len(sleep.calls)